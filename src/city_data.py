@@ -102,21 +102,21 @@ CITIES = [
 ]
 
 
+_CITY_BY_CODE: dict[str, dict] = {city["code"]: city for city in CITIES}
+_CITY_UZ: dict[str, str] = {city["code"]: city["uz"] for city in CITIES}
+_CITY_RU: dict[str, str] = {city["code"]: city["ru"] for city in CITIES}
+
+
 def get_city_by_code(code: str) -> dict | None:
     """Get city data by station code."""
-    for city in CITIES:
-        if city["code"] == code:
-            return city
-    return None
+    return _CITY_BY_CODE.get(code)
 
 
 def get_city_name_uz(code: str) -> str:
     """Get Uzbek city name by code."""
-    city = get_city_by_code(code)
-    return city["uz"] if city else code
+    return _CITY_UZ.get(code, code)
 
 
 def get_city_name_ru(code: str) -> str:
     """Get Russian city name by code."""
-    city = get_city_by_code(code)
-    return city["ru"] if city else code
+    return _CITY_RU.get(code, code)
@@ -1,74 +1,144 @@
+import logging
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+
 from get_api_token import get_api_token
 
+logger = logging.getLogger(__name__)
+
 BASE_URL = "https://e-ticket.railway.uz"
+AVAILABILITY_URL = f"{BASE_URL}/api/v3/trains/availability/space/between/stations"
+REQUEST_TIMEOUT = 10
+
+# Successful responses are reused for this many seconds
+CACHE_TTL = 25
+CACHE_MAXSIZE = 256
+
+_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Sec-Fetch-Site": "same-origin",
+    "Accept-Language": "uz",
+    "Sec-Fetch-Mode": "cors",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Origin": "https://e-ticket.railway.uz",
+    "Referer": "https://e-ticket.railway.uz/uz/pages/trains-page",
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/26.0.1 Safari/605.1.15",
+    "Connection": "keep-alive",
+    "Sec-Fetch-Dest": "empty",
+    "device-type": "BROWSER",
+    "X-XSRF-TOKEN": get_api_token(),
+}
+
+_COOKIES = {
+    "XSRF-TOKEN": get_api_token()
+}
+
+# Request body fields shared by every availability query
+_PAYLOAD_TEMPLATE = {
+    "direction": [],
+    "stationFrom": "",
+    "stationTo": "",
+    "detailNumPlaces": 1,
+    "showWithoutPlaces": 0
+}
+
+
+class _IgnoreResponseCookies(DefaultCookiePolicy):
+    """Cookie policy that keeps the configured XSRF cookie authoritative."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+# Shared session so monitors reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.headers.update(_HEADERS)
+_SESSION.cookies.set_policy(_IgnoreResponseCookies())
+_SESSION.cookies.update(_COOKIES)
 
 
-def get_train_availability(station_from, station_to, date):
+def set_api_token(new_token: str):
+    """Replace the XSRF token sent with API requests."""
+    _SESSION.headers["X-XSRF-TOKEN"] = new_token
+    _SESSION.cookies.set("XSRF-TOKEN", new_token)
+
+
+# (station_from, station_to, date) -> (monotonic fetch time, response data)
+_cache: dict[tuple[str, str, str], tuple[float, dict]] = {}
+_cache_lock = threading.Lock()
+
+
+def get_train_availability(station_from: str, station_to: str, date: str, max_age: float = CACHE_TTL) -> dict:
     """
     Check train availability between two stations.
 
+    Responses fetched less than max_age seconds ago are served from an
+    in-process cache. Error responses are never cached.
+
     Args:
         station_from: Departure station ID
         station_to: Destination station ID
         date: Date in format 'dd.mm.yyyy' (e.g., '31.10.2025')
+        max_age: Maximum age in seconds of a cached response to reuse
 
     Returns:
         dict: JSON response from the API
     """
-    url = f"{BASE_URL}/api/v3/trains/availability/space/between/stations"
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Sec-Fetch-Site": "same-origin",
-        "Accept-Language": "uz",
-        "Sec-Fetch-Mode": "cors",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Origin": "https://e-ticket.railway.uz",
-        "Referer": "https://e-ticket.railway.uz/uz/pages/trains-page",
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/26.0.1 Safari/605.1.15",
-        "Connection": "keep-alive",
-        "Sec-Fetch-Dest": "empty",
-        "device-type": "BROWSER",
-        "X-XSRF-TOKEN": get_api_token(),
-    }
-
-    payload = {
-        "direction": [
-            {
-                "depDate": date,
-                "fullday": True,
-                "type": "Forward"
-            }
-        ],
-        "stationFrom": str(station_from),
-        "stationTo": str(station_to),
-        "detailNumPlaces": 1,
-        "showWithoutPlaces": 0
-    }
-
-    cookies = {
-        "XSRF-TOKEN": get_api_token()
-    }
-
-    response = requests.post(url, headers=headers, cookies=cookies, json=payload)
-    print(f"API Status: {response.status_code}")
-    print(f"Response length: {len(response.content)} bytes")
+    key = (station_from, station_to, date)
+    cached = _cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+
+    data = _fetch_train_availability(station_from, station_to, date)
+
+    if not data.get('hasError'):
+        with _cache_lock:
+            _cache.pop(key, None)
+            _cache[key] = (time.monotonic(), data)
+            # Evict the oldest entry once the cache is full
+            if len(_cache) > CACHE_MAXSIZE:
+                del _cache[next(iter(_cache))]
+
+    return data
+
+
+def _fetch_train_availability(station_from: str, station_to: str, date: str) -> dict:
+    """Request train availability from the API, bypassing the cache."""
+    payload = _PAYLOAD_TEMPLATE.copy()
+    payload["direction"] = [{"depDate": date, "fullday": True, "type": "Forward"}]
+    payload["stationFrom"] = station_from
+    payload["stationTo"] = station_to
+
+    response = _SESSION.post(AVAILABILITY_URL, data=orjson.dumps(payload), timeout=REQUEST_TIMEOUT)
+    raw = response.content
+    logger.debug("API status %s, %d bytes", response.status_code, len(raw))
+
+    # Error envelopes declare hasError right at the start; callers only look
+    # at the flag, so skip decoding the rest of the body
+    if b'"hasError":true' in raw[:256]:
+        logger.debug("API returned an error envelope")
+        return {'hasError': True}
 
     try:
-        raw_data = response.json()
+        raw_data = orjson.loads(raw)
 
         # The API now wraps the response in an 'express' key
         if 'express' in raw_data:
             data = raw_data['express']
-            print(f"Extracted from 'express' wrapper. hasError: {data.get('hasError', False)}")
+            logger.debug("Extracted from 'express' wrapper. hasError: %s", data.get('hasError', False))
         else:
             # Fallback for old API format (if they change it back)
             data = raw_data
-            print(f"Using direct response. hasError: {data.get('hasError', False)}")
+            logger.debug("Using direct response. hasError: %s", data.get('hasError', False))
 
         return data
     except ValueError as e:
-        print(f"JSON parsing error: {e}")
-        print(f"Response text: {response.text[:200]}")
+        logger.error("JSON parsing error: %s. Response text: %s", e, response.text[:200])
         raise
@@ -1,8 +1,15 @@
+"""
+Parsing and formatting of train availability data.
+
+Kept fully type-annotated so it can be compiled with mypyc (see README).
+"""
+
 import json
-from typing import List, Dict, Any
+from itertools import chain, starmap
+from typing import List, Dict, Any, Iterator
 
 
-def extract_train_info(data: dict) -> List[Dict[str, Any]]:
+def extract_train_info(data: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
     Extract train information from API response.
 
@@ -19,7 +26,7 @@ def extract_train_info(data: dict) -> List[Dict[str, Any]]:
     if data['hasError']:
         raise ValueError("API returned error")
 
-    result = []
+    result: List[Dict[str, Any]] = []
 
     # Get direction (using first/forward direction)
     direction = data['direction'][0]
@@ -27,54 +34,60 @@ def extract_train_info(data: dict) -> List[Dict[str, Any]]:
     # Iterate over available trains
     for train_group in direction['trains']:
         for train_data in train_group['train']:
+            cars = train_data['places']['cars']
+
             # Filter out trains with no available seats
-            if not train_data['places']['cars']:
+            if not cars:
                 continue
 
             # Extract car information
-            cars_info = []
-            for car in train_data['places']['cars']:
+            cars_info: List[Dict[str, Any]] = []
+            for car in cars:
+                tariffs = car['tariffs']['tariff']
+                if not tariffs:
+                    continue
+
                 # Get first tariff (usually there's only one)
-                tariff_data = car['tariffs']['tariff'][0] if car['tariffs']['tariff'] else None
-
-                if tariff_data:
-                    # Calculate price (tariff + comissionFee)
-                    price = int(tariff_data['tariff']) + int(tariff_data['comissionFee'])
-
-                    # Extract seat details
-                    seats = tariff_data['seats']
-                    seat_breakdown = {
-                        'seatsUndef': seats.get('seatsUndef'),
-                        'seatsDn': seats.get('seatsDn'),
-                        'seatsUp': seats.get('seatsUp'),
-                        'seatsLateralDn': seats.get('seatsLateralDn'),
-                        'seatsLateralUp': seats.get('seatsLateralUp')
-                    }
-
-                    car_info = {
-                        'type': car['type'],
-                        'freeSeats': int(car['freeSeats']),
-                        'seatBreakdown': seat_breakdown,
-                        'price': price
-                    }
-                    cars_info.append(car_info)
+                tariff_data = tariffs[0]
+
+                # Calculate price (tariff + comissionFee)
+                price = int(tariff_data['tariff']) + int(tariff_data['comissionFee'])
+
+                # Extract seat details
+                seats = tariff_data['seats']
+                seat_breakdown = {
+                    'seatsUndef': seats.get('seatsUndef'),
+                    'seatsDn': seats.get('seatsDn'),
+                    'seatsUp': seats.get('seatsUp'),
+                    'seatsLateralDn': seats.get('seatsLateralDn'),
+                    'seatsLateralUp': seats.get('seatsLateralUp')
+                }
+
+                car_info = {
+                    'type': car['type'],
+                    'freeSeats': int(car['freeSeats']),
+                    'seatBreakdown': seat_breakdown,
+                    'price': price
+                }
+                cars_info.append(car_info)
 
             # Extract route information
-            route_start = train_data['route']['station'][0]
-            route_end = train_data['route']['station'][-1]
+            route_stations = train_data['route']['station']
+            departure = train_data['departure']
+            arrival = train_data['arrival']
 
             # Build train info dictionary
             train_info = {
                 'trainNumber': train_data['number'],
                 'brand': train_data['brand'],
-                'departureTime': train_data['departure']['localTime'],
-                'departureDate': train_data['departure']['localDate'],
-                'arrivalTime': train_data['arrival']['localTime'],
-                'arrivalDate': train_data['arrival']['localDate'],
+                'departureTime': departure['localTime'],
+                'departureDate': departure['localDate'],
+                'arrivalTime': arrival['localTime'],
+                'arrivalDate': arrival['localDate'],
                 'timeInWay': train_data['timeInWay'],
                 'route': {
-                    'from': route_start,
-                    'to': route_end
+                    'from': route_stations[0],
+                    'to': route_stations[-1]
                 },
                 'cars': cars_info
             }
@@ -84,12 +97,51 @@ def extract_train_info(data: dict) -> List[Dict[str, Any]]:
     return result
 
 
-def format_train_info_readable(trains: List[Dict[str, Any]]) -> str:
+# (breakdown key, label) pairs in display order
+_SEAT_LABELS: tuple[tuple[str, str], ...] = (
+    ('seatsUndef', 'Undefined'),
+    ('seatsDn', 'Lower'),
+    ('seatsUp', 'Upper'),
+    ('seatsLateralDn', 'Lateral lower'),
+    ('seatsLateralUp', 'Lateral upper'),
+)
+
+_DIVIDER = '=' * 30
+
+
+def _render_train(i: int, train: Dict[str, Any]) -> Iterator[str]:
+    """Yield the output lines for a single train."""
+    yield f"\n{_DIVIDER}"
+    yield f"Train #{i}: {train['trainNumber']} ({train['brand']})"
+    yield _DIVIDER
+    yield f"Departure: {train['departureTime']} ({train['departureDate']})"
+    yield f"Arrival: {train['arrivalTime']} ({train['arrivalDate']})"
+    yield f"Duration: {train['timeInWay']}"
+    yield "\nAvailable cars:"
+
+    for car in train['cars']:
+        yield f"\n  {car['type']}:"
+        yield f"    Total seats: {car['freeSeats']}"
+        yield f"    Price: {car['price']:,} so'm"
+
+        # Show seat breakdown
+        breakdown = car['seatBreakdown']
+        seats_detail = ', '.join(
+            f"{label}: {breakdown[key]}" for key, label in _SEAT_LABELS if breakdown[key]
+        )
+        if seats_detail:
+            yield f"    Breakdown: {seats_detail}"
+
+    yield f"Route: {train['route']['from']} → {train['route']['to']}"
+
+
+def format_train_info_readable(trains: List[Dict[str, Any]], start: int = 1) -> str:
     """
     Format train information into a human-readable string.
 
     Args:
         trains: List of train information dictionaries
+        start: Number shown for the first train
 
     Returns:
         Formatted string with train details
@@ -97,41 +149,7 @@ def format_train_info_readable(trains: List[Dict[str, Any]]) -> str:
     if not trains:
         return "No trains with available seats found."
 
-    output = []
-    for i, train in enumerate(trains, 1):
-        output.append(f"\n{'='*30}")
-        output.append(f"Train #{i}: {train['trainNumber']} ({train['brand']})")
-        output.append(f"{'='*30}")
-        output.append(f"Departure: {train['departureTime']} ({train['departureDate']})")
-        output.append(f"Arrival: {train['arrivalTime']} ({train['arrivalDate']})")
-        output.append(f"Duration: {train['timeInWay']}")
-        output.append(f"\nAvailable cars:")
-
-        for car in train['cars']:
-            output.append(f"\n  {car['type']}:")
-            output.append(f"    Total seats: {car['freeSeats']}")
-            output.append(f"    Price: {car['price']:,} so'm")
-
-            # Show seat breakdown
-            breakdown = car['seatBreakdown']
-            seats_detail = []
-            if breakdown['seatsUndef']:
-                seats_detail.append(f"Undefined: {breakdown['seatsUndef']}")
-            if breakdown['seatsDn']:
-                seats_detail.append(f"Lower: {breakdown['seatsDn']}")
-            if breakdown['seatsUp']:
-                seats_detail.append(f"Upper: {breakdown['seatsUp']}")
-            if breakdown['seatsLateralDn']:
-                seats_detail.append(f"Lateral lower: {breakdown['seatsLateralDn']}")
-            if breakdown['seatsLateralUp']:
-                seats_detail.append(f"Lateral upper: {breakdown['seatsLateralUp']}")
-
-            if seats_detail:
-                output.append(f"    Breakdown: {', '.join(seats_detail)}")
-        
-        output.append(f"Route: {train['route']['from']} → {train['route']['to']}")
-    
-    return '\n'.join(output)
+    return '\n'.join(chain.from_iterable(starmap(_render_train, enumerate(trains, start))))
 
 
 # if __name__ == "__main__":
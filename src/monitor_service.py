@@ -5,8 +5,11 @@ Train monitoring service for checking availability and sending notifications.
 import aiosqlite
 import asyncio
 import logging
+import time
+from contextlib import asynccontextmanager
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable
 from pathlib import Path
 
 from get_trains import get_train_availability
@@ -16,10 +19,63 @@ logger = logging.getLogger(__name__)
 
 DB_PATH = Path("train_monitors.db")
 
+_db: aiosqlite.Connection | None = None
+
+# The connection is shared by every coroutine, so writes are serialised
+# to keep one coroutine from committing another's half-done transaction
+_write_lock = asyncio.Lock()
+
+# Maximum number of railway API requests in flight at once
+MAX_CONCURRENT_FETCHES = 8
+_fetch_semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+# user_id -> active monitors, dropped whenever that user's monitors change
+# and least recently used first once the cap is reached
+MAX_CACHED_USERS = 10_000
+_user_monitors_cache: OrderedDict[int, List[Dict[str, Any]]] = OrderedDict()
+_user_monitors_generation = 0
+
+# Bounds in seconds for how long the monitor loop sleeps between passes
+MIN_SLEEP = 1
+MAX_SLEEP = 30
+
+
+async def get_db() -> aiosqlite.Connection:
+    """Get the shared database connection, opening it on first use."""
+    global _db
+    if _db is None:
+        _db = await aiosqlite.connect(DB_PATH)
+        _db.row_factory = aiosqlite.Row
+        await _db.execute("PRAGMA journal_mode=WAL")
+        await _db.execute("PRAGMA synchronous=NORMAL")
+        await _db.execute("PRAGMA temp_store=MEMORY")
+    return _db
+
+
+async def close_database():
+    """Close the shared database connection."""
+    global _db
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+
+@asynccontextmanager
+async def _transaction():
+    """Run a write transaction, committing on success and rolling back on error."""
+    db = await get_db()
+    async with _write_lock:
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
 
 async def init_database():
     """Initialize the database schema."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _transaction() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS monitors (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -29,14 +85,40 @@ async def init_database():
                 station_to TEXT NOT NULL,
                 travel_date TEXT NOT NULL,
                 check_interval INTEGER NOT NULL,
-                last_check TIMESTAMP,
-                known_trains TEXT,
+                last_check INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 active BOOLEAN DEFAULT 1
             )
         """)
-        await db.commit()
-        logger.info("Database initialized")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS known_trains (
+                monitor_id INTEGER NOT NULL,
+                train_number TEXT NOT NULL,
+                PRIMARY KEY (monitor_id, train_number)
+            )
+        """)
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_due ON monitors(active, last_check)"
+        )
+        # Migrate the legacy JSON known_trains column into the known_trains table
+        async with db.execute("PRAGMA table_info(monitors)") as cursor:
+            columns = {row['name'] for row in await cursor.fetchall()}
+        if 'known_trains' in columns:
+            await db.execute("""
+                INSERT OR IGNORE INTO known_trains (monitor_id, train_number)
+                SELECT monitors.id, trains.value
+                FROM monitors, json_each(monitors.known_trains) AS trains
+                WHERE json_valid(monitors.known_trains)
+            """)
+            await db.execute("ALTER TABLE monitors DROP COLUMN known_trains")
+            logger.info("Migrated known_trains column to known_trains table")
+        # Migrate last_check values written as TIMESTAMP text to unix seconds
+        await db.execute("""
+            UPDATE monitors
+            SET last_check = CAST(strftime('%s', last_check) AS INTEGER)
+            WHERE typeof(last_check) = 'text'
+        """)
+    logger.info("Database initialized")
 
 
 async def add_monitor(
@@ -54,164 +136,298 @@ async def add_monitor(
     Returns:
         Monitor ID
     """
-    import json
-
     # Get current trains to initialize known_trains
     initial_trains = []
+    last_check = None
     try:
-        data = get_train_availability(station_from, station_to, travel_date)
-        if not data.get('hasError'):
-            current_trains = extract_train_info(data)
+        current_trains = await fetch_current_trains(station_from, station_to, travel_date)
+        if current_trains is not None:
             initial_trains = [t['trainNumber'] for t in current_trains]
-            logger.info(f"Initialized monitor with {len(initial_trains)} existing trains")
+            last_check = int(time.time())
+            logger.info("Initialized monitor with %d existing trains", len(initial_trains))
     except Exception as e:
-        logger.warning(f"Could not fetch initial trains for monitor: {e}")
+        logger.warning("Could not fetch initial trains for monitor: %s", e)
         # Continue with empty list
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _transaction() as db:
         cursor = await db.execute(
             """
             INSERT INTO monitors (
                 user_id, chat_id, station_from, station_to,
-                travel_date, check_interval, known_trains
+                travel_date, check_interval, last_check
             )
             VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-            (user_id, chat_id, station_from, station_to, travel_date, check_interval, json.dumps(initial_trains))
+            (user_id, chat_id, station_from, station_to, travel_date, check_interval, last_check)
         )
-        await db.commit()
         monitor_id = cursor.lastrowid
-        logger.info(f"Added monitor {monitor_id} for user {user_id}")
-        return monitor_id
+        await db.executemany(
+            "INSERT OR IGNORE INTO known_trains (monitor_id, train_number) VALUES (?, ?)",
+            [(monitor_id, train_number) for train_number in initial_trains]
+        )
+    _invalidate_user_monitors(user_id)
+    logger.info("Added monitor %s for user %s", monitor_id, user_id)
+    return monitor_id
 
 
-async def get_user_monitors(user_id: int) -> List[Dict[str, Any]]:
-    """Get all active monitors for a user."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            """
-            SELECT * FROM monitors
-            WHERE user_id = ? AND active = 1
-            ORDER BY created_at DESC
-            """,
-            (user_id,)
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+def _invalidate_user_monitors(user_id: int | None = None):
+    """Drop cached monitor lists for one user, or for everyone."""
+    global _user_monitors_generation
+    _user_monitors_generation += 1
+    if user_id is None:
+        _user_monitors_cache.clear()
+    else:
+        _user_monitors_cache.pop(user_id, None)
 
 
-async def get_all_active_monitors() -> List[Dict[str, Any]]:
-    """Get all active monitors."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT * FROM monitors WHERE active = 1"
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+async def get_user_monitors(user_id: int) -> List[Dict[str, Any]]:
+    """
+    Get all active monitors for a user.
+
+    Results are cached until the user's monitors are added or stopped;
+    last_check in cached rows may be stale. Callers must not modify the
+    returned list.
+    """
+    cached = _user_monitors_cache.get(user_id)
+    if cached is not None:
+        _user_monitors_cache.move_to_end(user_id)
+        return cached
+
+    generation = _user_monitors_generation
+    db = await get_db()
+    async with db.execute(
+        """
+        SELECT * FROM monitors
+        WHERE user_id = ? AND active = 1
+        ORDER BY created_at DESC
+        """,
+        (user_id,)
+    ) as cursor:
+        rows = await cursor.fetchall()
+        monitors = [dict(row) for row in rows]
+
+    # Don't cache a result that was invalidated while the query ran
+    if generation == _user_monitors_generation:
+        _user_monitors_cache[user_id] = monitors
+        _user_monitors_cache.move_to_end(user_id)
+        if len(_user_monitors_cache) > MAX_CACHED_USERS:
+            _user_monitors_cache.popitem(last=False)
+    return monitors
+
+
+async def get_due_monitors(now_ts: int) -> List[Dict[str, Any]]:
+    """Get active monitors whose check interval has elapsed at now_ts."""
+    db = await get_db()
+    async with db.execute(
+        """
+        SELECT * FROM monitors
+        WHERE active = 1
+          AND (last_check IS NULL OR last_check + check_interval * 60 <= ?)
+        """,
+        (now_ts,)
+    ) as cursor:
+        rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
+
+
+async def get_next_due_time() -> int | None:
+    """Get the unix time at which the next active monitor becomes due."""
+    db = await get_db()
+    async with db.execute(
+        """
+        SELECT MIN(COALESCE(last_check, 0) + check_interval * 60) AS next_due
+        FROM monitors
+        WHERE active = 1
+        """
+    ) as cursor:
+        row = await cursor.fetchone()
+        return row['next_due']
 
 
 async def stop_monitor(monitor_id: int):
     """Deactivate a monitor."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE monitors SET active = 0 WHERE id = ?",
+    async with _transaction() as db:
+        async with db.execute(
+            "UPDATE monitors SET active = 0 WHERE id = ? RETURNING user_id",
             (monitor_id,)
-        )
-        await db.commit()
-        logger.info(f"Stopped monitor {monitor_id}")
+        ) as cursor:
+            rows = await cursor.fetchall()
+    for row in rows:
+        _invalidate_user_monitors(row['user_id'])
+    logger.info("Stopped monitor %s", monitor_id)
 
 
 async def stop_all_user_monitors(user_id: int):
     """Deactivate all monitors for a user."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _transaction() as db:
         await db.execute(
             "UPDATE monitors SET active = 0 WHERE user_id = ?",
             (user_id,)
         )
-        await db.commit()
-        logger.info(f"Stopped all monitors for user {user_id}")
-
+    _invalidate_user_monitors(user_id)
+    logger.info("Stopped all monitors for user %s", user_id)
+
+
+async def get_known_trains(monitor_id: int) -> set[str]:
+    """Get the train numbers a monitor has already seen."""
+    db = await get_db()
+    async with db.execute(
+        "SELECT train_number FROM known_trains WHERE monitor_id = ?",
+        (monitor_id,)
+    ) as cursor:
+        return {row['train_number'] for row in await cursor.fetchall()}
+
+
+async def update_monitor_check(
+    monitor_id: int,
+    added_trains: Iterable[str],
+    removed_trains: Iterable[str]
+):
+    """Update last check time and apply the known trains delta."""
+    async with _transaction() as db:
+        await db.execute(
+            "UPDATE monitors SET last_check = ? WHERE id = ?",
+            (int(time.time()), monitor_id)
+        )
+        await db.executemany(
+            "DELETE FROM known_trains WHERE monitor_id = ? AND train_number = ?",
+            [(monitor_id, train_number) for train_number in removed_trains]
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO known_trains (monitor_id, train_number) VALUES (?, ?)",
+            [(monitor_id, train_number) for train_number in added_trains]
+        )
 
-async def update_monitor_check(monitor_id: int, known_trains: List[str]):
-    """Update last check time and known trains."""
-    import json
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            UPDATE monitors
-            SET last_check = CURRENT_TIMESTAMP, known_trains = ?
-            WHERE id = ?
-            """,
-            (json.dumps(known_trains), monitor_id)
+async def mark_monitors_checked(monitor_ids: Iterable[int]):
+    """Record a check attempt without touching the known trains."""
+    now = int(time.time())
+    async with _transaction() as db:
+        await db.executemany(
+            "UPDATE monitors SET last_check = ? WHERE id = ?",
+            [(now, monitor_id) for monitor_id in monitor_ids]
         )
-        await db.commit()
 
 
 async def cleanup_expired_monitors():
     """Deactivate monitors for past travel dates."""
     today = datetime.now().strftime("%d.%m.%Y")
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _transaction() as db:
         cursor = await db.execute(
             "UPDATE monitors SET active = 0 WHERE travel_date < ? AND active = 1",
             (today,)
         )
-        await db.commit()
-        if cursor.rowcount > 0:
-            logger.info(f"Cleaned up {cursor.rowcount} expired monitors")
+    if cursor.rowcount > 0:
+        _invalidate_user_monitors()
+        logger.info("Cleaned up %d expired monitors", cursor.rowcount)
 
 
-async def check_monitor(monitor: Dict[str, Any], bot) -> List[Dict[str, Any]]:
+async def fetch_current_trains(
+    station_from: str,
+    station_to: str,
+    travel_date: str
+) -> List[Dict[str, Any]] | None:
     """
-    Check a single monitor for new trains.
+    Fetch trains with available seats for a route.
 
     Returns:
-        List of new trains that appeared
+        List of trains, or None if the API returned an error
     """
-    import json
-
-    try:
-        # Fetch current train data
-        data = get_train_availability(
-            monitor['station_from'],
-            monitor['station_to'],
-            monitor['travel_date']
+    # Run the blocking request in a thread so the event loop stays responsive
+    async with _fetch_semaphore:
+        data = await asyncio.to_thread(
+            get_train_availability, station_from, station_to, travel_date
         )
 
-        if data.get('hasError'):
-            logger.warning(f"API error for monitor {monitor['id']}")
-            return []
+    if data.get('hasError'):
+        return None
+
+    return extract_train_info(data)
+
+
+async def diff_against_known(
+    current_trains: List[Dict[str, Any]],
+    monitor: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """
+    Compare current trains with the ones a monitor has already seen.
+
+    Returns:
+        List of new trains that appeared
+    """
+    # Load known trains
+    known_train_numbers = await get_known_trains(monitor['id'])
+
+    # Find new trains in a single pass over the current list
+    new_trains = [t for t in current_trains if t['trainNumber'] not in known_train_numbers]
+
+    # Update known trains; trains that sold out are forgotten so they
+    # are reported again once seats reappear
+    await update_monitor_check(
+        monitor['id'],
+        [t['trainNumber'] for t in new_trains],
+        known_train_numbers.difference(t['trainNumber'] for t in current_trains)
+    )
 
-        # Extract current trains
-        current_trains = extract_train_info(data)
-        current_train_numbers = {t['trainNumber'] for t in current_trains}
+    return new_trains
 
-        # Load known trains
-        known_train_numbers = set(json.loads(monitor['known_trains'] or '[]'))
 
-        # Find new trains
-        new_train_numbers = current_train_numbers - known_train_numbers
-        new_trains = [t for t in current_trains if t['trainNumber'] in new_train_numbers]
+async def check_route(
+    route: tuple[str, str, str],
+    monitors: List[Dict[str, Any]]
+) -> List[tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """
+    Fetch a route once and check every monitor watching it.
 
-        # Update known trains
-        await update_monitor_check(monitor['id'], list(current_train_numbers))
+    Args:
+        route: (station_from, station_to, travel_date)
+        monitors: Due monitors for this route
 
-        return new_trains
+    Returns:
+        List of (monitor, new trains) pairs
+    """
+    # A failed attempt still counts as a check, so a broken route is
+    # retried after its own interval instead of keeping the loop busy
+    try:
+        current_trains = await fetch_current_trains(*route)
+    except Exception:
+        logger.exception("Error fetching trains for route %s", route)
+        await mark_monitors_checked(monitor['id'] for monitor in monitors)
+        return []
 
-    except Exception as e:
-        logger.error(f"Error checking monitor {monitor['id']}: {e}")
+    if current_trains is None:
+        logger.warning("API error for route %s", route)
+        await mark_monitors_checked(monitor['id'] for monitor in monitors)
         return []
 
+    results = []
+    for monitor in monitors:
+        try:
+            new_trains = await diff_against_known(current_trains, monitor)
+        except Exception:
+            logger.exception("Error checking monitor %s", monitor['id'])
+            await mark_monitors_checked([monitor['id']])
+            continue
+        results.append((monitor, new_trains))
+
+    return results
+
 
 def format_train_summary(train: Dict[str, Any]) -> str:
     """Format a brief train summary for notifications."""
-    # Get total seats and price from first car
-    total_seats = sum(car['freeSeats'] for car in train['cars'])
-    prices = [car['price'] for car in train['cars']]
-    price_range = f"{min(prices):,}" if len(set(prices)) == 1 else f"{min(prices):,}-{max(prices):,}"
+    # Total seats and price range across all cars in a single pass
+    total_seats = 0
+    min_price = max_price = None
+    for car in train['cars']:
+        total_seats += car['freeSeats']
+        price = car['price']
+        if min_price is None or price < min_price:
+            min_price = price
+        if max_price is None or price > max_price:
+            max_price = price
+
+    price_range = f"{min_price:,}" if min_price == max_price else f"{min_price:,}-{max_price:,}"
 
     return (
         f"Train {train['trainNumber']} ({train['brand']})\n"
@@ -222,17 +438,20 @@ def format_train_summary(train: Dict[str, Any]) -> str:
     )
 
 
+async def send_notification(bot, monitor: Dict[str, Any], train: Dict[str, Any]):
+    """Notify a monitor's chat about a newly available train."""
+    summary = format_train_summary(train)
+    await bot.send_message(
+        chat_id=monitor['chat_id'],
+        text=f"🔔 New train available!\n\n{summary}"
+    )
+    logger.info("Sent notification for train %s to user %s", train['trainNumber'], monitor['user_id'])
+
+
 async def monitor_loop(bot):
     """Background task that checks monitors periodically."""
     logger.info("Starting monitor loop")
 
-    # Group monitors by check interval
-    check_groups = {
-        1: [],   # 1 minute
-        5: [],   # 5 minutes
-        10: [],  # 10 minutes
-    }
-
     last_cleanup = datetime.now()
 
     while True:
@@ -242,49 +461,51 @@ async def monitor_loop(bot):
                 await cleanup_expired_monitors()
                 last_cleanup = datetime.now()
 
-            # Get all active monitors
-            monitors = await get_all_active_monitors()
-
-            # Organize by interval
-            for interval in check_groups:
-                check_groups[interval] = []
-
-            for monitor in monitors:
-                interval = monitor['check_interval']
-                if interval in check_groups:
-                    check_groups[interval].append(monitor)
-
-            # Check monitors based on their interval
-            now = datetime.now()
-            for interval, monitors_list in check_groups.items():
-                for monitor in monitors_list:
-                    # Check if it's time to check this monitor
-                    last_check = monitor['last_check']
-                    if last_check:
-                        last_check_time = datetime.fromisoformat(last_check)
-                        if (now - last_check_time).total_seconds() < interval * 60:
-                            continue
-
-                    # Check for new trains
-                    new_trains = await check_monitor(monitor, bot)
-
-                    # Send notifications
-                    for train in new_trains:
-                        try:
-                            summary = format_train_summary(train)
-                            message = f"🔔 New train available!\n\n{summary}"
-
-                            await bot.send_message(
-                                chat_id=monitor['chat_id'],
-                                text=message
-                            )
-                            logger.info(f"Sent notification for train {train['trainNumber']} to user {monitor['user_id']}")
-                        except Exception as e:
-                            logger.error(f"Error sending notification: {e}")
-
-            # Sleep for 30 seconds before next iteration
-            await asyncio.sleep(30)
-
-        except Exception as e:
-            logger.error(f"Error in monitor loop: {e}")
+            # Get monitors that are due for a check
+            due_monitors = await get_due_monitors(int(time.time()))
+
+            # Group monitors watching the same route and date so each
+            # route is fetched only once per tick
+            routes = defaultdict(list)
+            for monitor in due_monitors:
+                route = (monitor['station_from'], monitor['station_to'], monitor['travel_date'])
+                routes[route].append(monitor)
+
+            # Check routes concurrently
+            results = await asyncio.gather(
+                *(check_route(route, monitors) for route, monitors in routes.items()),
+                return_exceptions=True
+            )
+
+            checked = []
+            for route_results in results:
+                if isinstance(route_results, Exception):
+                    logger.error("Error checking route", exc_info=route_results)
+                    continue
+                checked.extend(route_results)
+
+            # Send notifications concurrently
+            results = await asyncio.gather(
+                *(
+                    send_notification(bot, monitor, train)
+                    for monitor, new_trains in checked
+                    for train in new_trains
+                ),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Error sending notification", exc_info=result)
+
+            # Sleep until the next monitor is due. A monitor that is still
+            # overdue after a pass couldn't even be marked as checked, so
+            # back off instead of retrying it every MIN_SLEEP
+            next_due = await get_next_due_time()
+            delay = MAX_SLEEP if next_due is None else next_due - time.time()
+            if delay <= 0:
+                delay = MAX_SLEEP
+            await asyncio.sleep(min(MAX_SLEEP, max(MIN_SLEEP, delay)))
+
+        except Exception:
+            logger.exception("Error in monitor loop")
             await asyncio.sleep(60)
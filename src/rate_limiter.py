@@ -0,0 +1,130 @@
+"""
+Rate limiting for outgoing Telegram Bot API requests.
+"""
+
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 requests per second per bot and
+# about one message per second in a single chat, with short bursts
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+# How many times a request rejected by flood control is retried
+MAX_RETRIES = 3
+
+# Forget idle chats once this many are tracked
+_MAX_TRACKED_CHATS = 1024
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out the time each request may be sent at.
+
+    Up to burst requests go out immediately, after that they are spaced
+    at the given rate. The bucket is stored as the time it becomes full
+    again (the generic cell rate algorithm), so refilling needs no timer.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.full_at = 0.0
+
+    def reserve(self, now: float) -> float:
+        """Take a token and return when it may be used."""
+        full_at = max(now, self.full_at)
+        self.full_at = full_at + self.interval
+        return max(now, full_at - self.tolerance)
+
+
+class RateLimiter:
+    """
+    Keeps requests under a global and a per-chat token bucket.
+
+    Every call reserves its token before sleeping, so concurrent callers
+    are queued in order without holding a lock. A chat waiting for its
+    own token does not hold up other chats.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        global_burst: int = GLOBAL_BURST,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: int = CHAT_BURST,
+    ):
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats: dict[int | str, TokenBucket] = {}
+
+    async def acquire(self, chat_id: int | str | None = None):
+        """Wait until a request (to chat_id, if given) may be sent."""
+        if chat_id is not None:
+            await _sleep_until(self._reserve_chat(chat_id))
+        await _sleep_until(self._global.reserve(time.monotonic()))
+
+    def _reserve_chat(self, chat_id: int | str) -> float:
+        now = time.monotonic()
+        if len(self._chats) > _MAX_TRACKED_CHATS:
+            # Buckets that are full again behave like new ones
+            self._chats = {
+                chat: bucket for chat, bucket in self._chats.items() if bucket.full_at > now
+            }
+
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket.reserve(now)
+
+
+async def _sleep_until(slot: float):
+    delay = slot - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Bot session middleware that rate limits every outgoing API call.
+
+    Requests rejected with TelegramRetryAfter are retried after the delay
+    Telegram asks for, up to max_retries times.
+    """
+
+    def __init__(self, limiter: RateLimiter | None = None, max_retries: int = MAX_RETRIES):
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(
+                    "Flood control on %s, retrying in %s s",
+                    type(method).__name__, e.retry_after
+                )
+                await asyncio.sleep(e.retry_after)
@@ -3,24 +3,34 @@ Telegram bot for checking train availability in Uzbekistan.
 """
 
 import os
+import asyncio
+import calendar
 import logging
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Iterable, Iterator
 from datetime import datetime, timedelta
+from functools import lru_cache
+from urllib.parse import urlsplit
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
 
 from city_data import CITIES, get_city_name_uz, get_city_name_ru
 from get_trains import get_train_availability
 from json_parser import extract_train_info, format_train_info_readable
 from monitor_service import (
-    init_database, add_monitor, get_user_monitors,
+    init_database, close_database, add_monitor, get_user_monitors,
     stop_monitor, stop_all_user_monitors, monitor_loop
 )
+from rate_limiter import RateLimitMiddleware
 
 
 # Load environment variables
@@ -35,8 +45,17 @@ BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN not found in environment variables!")
 
+# Public HTTPS URL for Telegram to post updates to. Without it the bot
+# falls back to long polling, which is fine for development
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
 # Initialize bot and dispatcher
 bot = Bot(token=BOT_TOKEN)
+# Pace every outgoing API call to stay within Telegram's rate limits
+bot.session.middleware(RateLimitMiddleware())
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
@@ -52,6 +71,37 @@ class MonitorSetup(StatesGroup):
     choosing_interval = State()
 
 
+# Message texts shared by several handlers
+_GREETING = "Assalomu alaykum! 🚆\n\n"
+_CHOOSE_FROM = "Please select your departure city:"
+_DIVIDER = "=" * 30
+_HEADER_TMPL = (
+    f"🚆 TRAIN SEARCH RESULTS\n"
+    f"{_DIVIDER}\n"
+    "Route: {route}\n"
+    "Date: {date}\n"
+    "Found {n} train(s) with available seats\n"
+    f"{_DIVIDER}\n"
+)
+
+# Background tasks are referenced here until they finish
+_background_tasks: set[asyncio.Task] = set()
+
+# Telegram's maximum message length, and the size results are packed to
+TELEGRAM_MESSAGE_LIMIT = 4096
+PACKED_MESSAGE_SIZE = 4000
+
+# Seconds a search result may be reused for identical searches
+SEARCH_TTL = 30
+
+# Most recent successful search per user, used to set up a monitor
+MAX_REMEMBERED_SEARCHES = 10_000
+_last_searches: OrderedDict[int, dict] = OrderedDict()
+
+# Check interval choices in minutes, keyed by their callback payload
+CHECK_INTERVALS = {"1": 1, "5": 5, "10": 10}
+
+
 def create_city_keyboard(exclude_code: str = None) -> InlineKeyboardMarkup:
     """Create keyboard with city buttons."""
     buttons = []
@@ -61,7 +111,7 @@ def create_city_keyboard(exclude_code: str = None) -> InlineKeyboardMarkup:
         # Display in Uzbek
         button = InlineKeyboardButton(
             text=city["uz"],
-            callback_data=f"city_{city['code']}"
+            callback_data=f"c:{city['code']}"
         )
         buttons.append([button])
 
@@ -70,25 +120,33 @@ def create_city_keyboard(exclude_code: str = None) -> InlineKeyboardMarkup:
 
 def create_date_keyboard() -> InlineKeyboardMarkup:
     """Create keyboard with date selection (next 14 days)."""
+    # The keyboard only changes when the day rolls over
+    return _build_date_keyboard(datetime.now().toordinal())
+
+
+@lru_cache(maxsize=1)
+def _build_date_keyboard(day_ordinal: int) -> InlineKeyboardMarkup:
+    """Build the date keyboard starting from the given day."""
     buttons = []
-    today = datetime.now()
+    today = datetime.fromordinal(day_ordinal)
 
     # Create 2 rows of 7 days each
     for i in range(14):
         date = today + timedelta(days=i)
-        date_str = date.strftime("%d.%m.%Y")
+        day_month = f"{date.day:02d}.{date.month:02d}"
+        date_str = f"{day_month}.{date.year}"
 
         # Label for button
         if i == 0:
-            label = f"Today ({date.strftime('%d.%m')})"
+            label = f"Today ({day_month})"
         elif i == 1:
-            label = f"Tomorrow ({date.strftime('%d.%m')})"
+            label = f"Tomorrow ({day_month})"
         else:
-            label = date.strftime("%d.%m (%a)")
+            label = f"{day_month} ({calendar.day_abbr[date.weekday()]})"
 
         button = InlineKeyboardButton(
             text=label,
-            callback_data=f"date_{date_str}"
+            callback_data=f"d:{date_str}"
         )
         buttons.append([button])
 
@@ -98,30 +156,109 @@ def create_date_keyboard() -> InlineKeyboardMarkup:
 def create_interval_keyboard() -> InlineKeyboardMarkup:
     """Create keyboard for selecting check interval."""
     buttons = [
-        [InlineKeyboardButton(text="Every 1 minute", callback_data="interval_1")],
-        [InlineKeyboardButton(text="Every 5 minutes", callback_data="interval_5")],
-        [InlineKeyboardButton(text="Every 10 minutes", callback_data="interval_10")],
+        [InlineKeyboardButton(text="Every 1 minute", callback_data="i:1")],
+        [InlineKeyboardButton(text="Every 5 minutes", callback_data="i:5")],
+        [InlineKeyboardButton(text="Every 10 minutes", callback_data="i:10")],
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+# These keyboards never change, so build them once
+_FULL_CITY_KB = create_city_keyboard()
+_CITY_KB_BY_EXCLUDE = {
+    city["code"]: create_city_keyboard(exclude_code=city["code"]) for city in CITIES
+}
+_INTERVAL_KB = create_interval_keyboard()
+
+# Buttons shown after every search and under every monitor list
+_ACTION_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="📡 Monitor this route", callback_data="su")],
+        [InlineKeyboardButton(text="🔍 New Search", callback_data="r")]
+    ]
+)
+_STOP_ALL_ROW = [
+    InlineKeyboardButton(text="Stop All Monitors", callback_data="sa")
+]
+
+
+def get_city_keyboard(exclude_code: str = None) -> InlineKeyboardMarkup:
+    """Get the prebuilt city keyboard, optionally without one city."""
+    if exclude_code is None:
+        return _FULL_CITY_KB
+    return _CITY_KB_BY_EXCLUDE.get(exclude_code) or create_city_keyboard(exclude_code)
+
+
+def _on_background_task_done(task: asyncio.Task):
+    """Release a finished background task and log its failure, if any."""
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Background task failed", exc_info=task.exception())
+
+
+def _answer_in_background(callback: CallbackQuery, *args, **kwargs):
+    """Acknowledge a callback query without waiting for Telegram's reply."""
+    task = asyncio.create_task(callback.answer(*args, **kwargs))
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+
+
+async def _edit_text_if_changed(message: Message, text: str, **kwargs):
+    """Edit a message, ignoring edits that would leave it unchanged."""
+    try:
+        await message.edit_text(text, **kwargs)
+    except TelegramBadRequest as e:
+        # e.g. both callbacks of a double tap render the same list
+        if "message is not modified" not in e.message:
+            raise
+
+
+def _remember_search(user_id: int, search: dict):
+    """Store a user's latest search, evicting the least recently used."""
+    _last_searches[user_id] = search
+    _last_searches.move_to_end(user_id)
+    if len(_last_searches) > MAX_REMEMBERED_SEARCHES:
+        _last_searches.popitem(last=False)
+
+
+def _forget_search(user_id: int):
+    """Drop a user's latest search, so it can't be monitored again."""
+    _last_searches.pop(user_id, None)
+
+
+def _pack_messages(parts: Iterable[str], limit: int = PACKED_MESSAGE_SIZE) -> Iterator[str]:
+    """Greedily join text parts with newlines into messages of at most limit chars."""
+    buf = []
+    size = 0
+    for part in parts:
+        extra = len(part) + 1 if buf else len(part)
+        if buf and size + extra > limit:
+            yield "\n".join(buf)
+            buf = []
+            size = 0
+            extra = len(part)
+        buf.append(part)
+        size += extra
+
+    if buf:
+        yield "\n".join(buf)
+
+
 @dp.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     """Handle /start command."""
     await state.clear()
+    _forget_search(message.from_user.id)
     await message.answer(
-        "Assalomu alaykum! 🚆\n\n"
-        "I can help you find available trains in Uzbekistan.\n\n"
-        "Please select your departure city:",
-        reply_markup=create_city_keyboard()
+        f"{_GREETING}I can help you find available trains in Uzbekistan.\n\n{_CHOOSE_FROM}",
+        reply_markup=get_city_keyboard()
     )
     await state.set_state(TrainSearch.choosing_from)
 
 
-@dp.callback_query(TrainSearch.choosing_from, F.data.startswith("city_"))
-async def process_from_city(callback: CallbackQuery, state: FSMContext):
+async def process_from_city(callback: CallbackQuery, city_code: str, state: FSMContext):
     """Process departure city selection."""
-    city_code = callback.data.split("_")[1]
+    _answer_in_background(callback)
     await state.update_data(from_city=city_code)
 
     city_name = get_city_name_uz(city_code)
@@ -129,16 +266,14 @@ async def process_from_city(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         f"Departure: {city_name}\n\n"
         f"Now select your destination city:",
-        reply_markup=create_city_keyboard(exclude_code=city_code)
+        reply_markup=get_city_keyboard(exclude_code=city_code)
     )
     await state.set_state(TrainSearch.choosing_to)
-    await callback.answer()
 
 
-@dp.callback_query(TrainSearch.choosing_to, F.data.startswith("city_"))
-async def process_to_city(callback: CallbackQuery, state: FSMContext):
+async def process_to_city(callback: CallbackQuery, city_code: str, state: FSMContext):
     """Process destination city selection."""
-    city_code = callback.data.split("_")[1]
+    _answer_in_background(callback)
     await state.update_data(to_city=city_code)
 
     data = await state.get_data()
@@ -151,13 +286,12 @@ async def process_to_city(callback: CallbackQuery, state: FSMContext):
         reply_markup=create_date_keyboard()
     )
     await state.set_state(TrainSearch.choosing_date)
-    await callback.answer()
 
 
-@dp.callback_query(TrainSearch.choosing_date, F.data.startswith("date_"))
-async def process_date(callback: CallbackQuery, state: FSMContext):
+async def process_date(callback: CallbackQuery, date_str: str, state: FSMContext):
     """Process date selection and fetch train data."""
-    date_str = callback.data.split("_")[1]
+    # Acknowledge right away; the search below can take a while
+    _answer_in_background(callback)
 
     # Get stored data
     data = await state.get_data()
@@ -177,8 +311,10 @@ async def process_date(callback: CallbackQuery, state: FSMContext):
     )
 
     try:
-        # Make API request
-        response_data = get_train_availability(from_city, to_city, date_str)
+        # Make API request in a worker thread so other updates keep flowing
+        response_data = await asyncio.to_thread(
+            get_train_availability, from_city, to_city, date_str, SEARCH_TTL
+        )
 
         # Check for errors
         if response_data.get("hasError"):
@@ -186,7 +322,7 @@ async def process_date(callback: CallbackQuery, state: FSMContext):
                 "Sorry, there was an error fetching train data. Please try again later."
             )
             await state.clear()
-            await callback.answer()
+            _forget_search(callback.from_user.id)
             return
 
         # Extract train information
@@ -204,109 +340,104 @@ async def process_date(callback: CallbackQuery, state: FSMContext):
             formatted_response = format_train_info_readable(trains)
 
             # Add header with route in caps (from passRoute)
-            header = (
-                f"🚆 TRAIN SEARCH RESULTS\n"
-                f"{'='*30}\n"
-                f"Route: {from_city_name_ru.upper()} → {to_city_name_ru.upper()}\n"
-                f"Date: {date_str}\n"
-                f"Found {len(trains)} train(s) with available seats\n"
-                f"{'='*30}\n"
+            header = _HEADER_TMPL.format(
+                route=f"{from_city_name_ru.upper()} → {to_city_name_ru.upper()}",
+                date=date_str,
+                n=len(trains)
             )
 
             full_message = header + formatted_response
 
             # Telegram has a 4096 character limit per message
-            if len(full_message) > 4096:
+            if len(full_message) > TELEGRAM_MESSAGE_LIMIT:
                 # Split into multiple messages
                 await callback.message.edit_text(header)
 
-                # Send trains in chunks
-                for train in trains:
-                    train_msg = format_train_info_readable([train])
-                    await callback.message.answer(train_msg)
+                # Pack as many trains as fit into each follow-up message
+                train_texts = (
+                    format_train_info_readable([train], start=i)
+                    for i, train in enumerate(trains, 1)
+                )
+                for chunk in _pack_messages(train_texts):
+                    await callback.message.answer(chunk)
             else:
                 await callback.message.edit_text(full_message)
 
             # Store search data for potential monitoring
-            await state.update_data(
-                last_search={
-                    'from': from_city,
-                    'to': to_city,
-                    'date': date_str
-                }
-            )
+            _remember_search(callback.from_user.id, {
+                'from': from_city,
+                'to': to_city,
+                'date': date_str
+            })
 
             # Add monitor and restart buttons
-            action_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="📡 Monitor this route", callback_data="setup_monitor")],
-                    [InlineKeyboardButton(text="🔍 New Search", callback_data="restart")]
-                ]
-            )
             await callback.message.answer(
                 "Use /start to make another search or monitor this route for new trains:",
-                reply_markup=action_keyboard
+                reply_markup=_ACTION_KB
             )
 
-        # Don't clear state here - keep it for monitoring setup
+        # The search for monitoring setup lives in _last_searches, so it
+        # outlives the FSM state; it is forgotten wherever the state is cleared
 
-    except Exception as e:
-        logger.error(f"Error processing request: {e}")
+    except Exception:
+        # Keep the details in the log, the user only needs to know it failed
+        logger.exception("Error processing request")
         await callback.message.edit_text(
-            f"An error occurred while searching for trains: {str(e)}\n\n"
-            f"Please try again with /start"
+            "An error occurred while searching for trains.\n\n"
+            "Please try again with /start"
         )
         await state.clear()
+        _forget_search(callback.from_user.id)
 
-    await callback.answer()
 
-
-@dp.callback_query(F.data == "restart")
-async def restart_search(callback: CallbackQuery, state: FSMContext):
+async def restart_search(callback: CallbackQuery, payload: str, state: FSMContext):
     """Restart the search process."""
+    _answer_in_background(callback)
     await state.clear()
+    _forget_search(callback.from_user.id)
     await callback.message.answer(
-        "Assalomu alaykum! 🚆\n\n"
-        "Please select your departure city:",
-        reply_markup=create_city_keyboard()
+        f"{_GREETING}{_CHOOSE_FROM}",
+        reply_markup=get_city_keyboard()
     )
     await state.set_state(TrainSearch.choosing_from)
-    await callback.answer()
 
 
 # === MONITORING HANDLERS ===
 
-@dp.callback_query(F.data == "setup_monitor")
-async def setup_monitor_handler(callback: CallbackQuery, state: FSMContext):
+async def setup_monitor_handler(callback: CallbackQuery, payload: str, state: FSMContext):
     """Start monitor setup process."""
-    data = await state.get_data()
-    last_search = data.get('last_search')
+    last_search = _last_searches.get(callback.from_user.id)
 
     if not last_search:
         await callback.answer("No recent search found. Please search for trains first.", show_alert=True)
         return
 
+    _answer_in_background(callback)
     await callback.message.answer(
         "Select how often to check for new trains:",
-        reply_markup=create_interval_keyboard()
+        reply_markup=_INTERVAL_KB
     )
     await state.set_state(MonitorSetup.choosing_interval)
-    await callback.answer()
 
 
-@dp.callback_query(MonitorSetup.choosing_interval, F.data.startswith("interval_"))
-async def process_interval_selection(callback: CallbackQuery, state: FSMContext):
+async def process_interval_selection(callback: CallbackQuery, payload: str, state: FSMContext):
     """Process interval selection and create monitor."""
-    interval = int(callback.data.split("_")[1])
+    interval = CHECK_INTERVALS.get(payload)
+    if interval is None:
+        await callback.answer()
+        return
 
-    data = await state.get_data()
-    last_search = data.get('last_search')
+    last_search = _last_searches.get(callback.from_user.id)
 
     if not last_search:
         await callback.answer("Search data lost. Please search again.", show_alert=True)
         await state.clear()
         return
 
+    # Answer now: creating a monitor fetches the route and can outlast
+    # Telegram's callback timeout. The result is shown by the edit below.
+    _answer_in_background(callback, "Creating monitor...")
+
     # Create monitor
     try:
         monitor_id = await add_monitor(
@@ -330,35 +461,26 @@ async def process_interval_selection(callback: CallbackQuery, state: FSMContext)
             f"Use /monitors to manage your active monitors."
         )
 
+        # A second tap on the old "Monitor this route" button must not
+        # create a duplicate monitor
         await state.clear()
-        await callback.answer("Monitor activated!")
+        _forget_search(callback.from_user.id)
 
-    except Exception as e:
-        logger.error(f"Error creating monitor: {e}")
+    except Exception:
+        logger.exception("Error creating monitor")
         await callback.message.edit_text("Error creating monitor. Please try again.")
-        await callback.answer("Error occurred", show_alert=True)
-
-
-@dp.message(F.text == "/monitors")
-async def list_monitors(message: Message):
-    """List all active monitors for the user."""
-    monitors = await get_user_monitors(message.from_user.id)
-
-    if not monitors:
-        await message.answer(
-            "You have no active monitors.\n\n"
-            "Search for trains and click 'Monitor this route' to start monitoring."
-        )
-        return
 
-    response = "📡 Your active monitors:\n\n"
 
+def _render_monitor_list(monitors: list[dict]) -> tuple[str, InlineKeyboardMarkup]:
+    """Build the monitor list text and its stop buttons."""
+    parts = ["📡 Your active monitors:\n\n"]
     buttons = []
+
     for monitor in monitors:
         from_name = get_city_name_uz(monitor['station_from'])
         to_name = get_city_name_uz(monitor['station_to'])
 
-        response += (
+        parts.append(
             f"🚆 {from_name} → {to_name}\n"
             f"   Date: {monitor['travel_date']}\n"
             f"   Interval: Every {monitor['check_interval']} min\n"
@@ -369,69 +491,146 @@ async def list_monitors(message: Message):
         buttons.append([
             InlineKeyboardButton(
                 text=f"Stop {from_name} → {to_name}",
-                callback_data=f"stop_monitor_{monitor['id']}"
+                callback_data=f"sm:{monitor['id']}"
             )
         ])
 
     # Add stop all button
-    buttons.append([
-        InlineKeyboardButton(text="Stop All Monitors", callback_data="stop_all_monitors")
-    ])
+    buttons.append(_STOP_ALL_ROW)
+
+    return "".join(parts), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.message(F.text == "/monitors")
+async def list_monitors(message: Message):
+    """List all active monitors for the user."""
+    monitors = await get_user_monitors(message.from_user.id)
+
+    if not monitors:
+        await message.answer(
+            "You have no active monitors.\n\n"
+            "Search for trains and click 'Monitor this route' to start monitoring."
+        )
+        return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    response, keyboard = _render_monitor_list(monitors)
     await message.answer(response, reply_markup=keyboard)
 
 
-@dp.callback_query(F.data.startswith("stop_monitor_"))
-async def stop_monitor_handler(callback: CallbackQuery):
+async def stop_monitor_handler(callback: CallbackQuery, payload: str, state: FSMContext):
     """Stop a specific monitor."""
-    monitor_id = int(callback.data.split("_")[2])
+    monitor_id = int(payload)
 
+    # The local write is fast; confirm only once it has succeeded
     await stop_monitor(monitor_id)
-    await callback.answer("Monitor stopped", show_alert=True)
+    _answer_in_background(callback, "Monitor stopped")
 
     # Refresh the list
     monitors = await get_user_monitors(callback.from_user.id)
 
     if not monitors:
-        await callback.message.edit_text("All monitors stopped.")
+        await _edit_text_if_changed(callback.message, "All monitors stopped.")
         return
 
-    response = "📡 Your active monitors:\n\n"
-    buttons = []
+    response, keyboard = _render_monitor_list(monitors)
+    await _edit_text_if_changed(callback.message, response, reply_markup=keyboard)
 
-    for monitor in monitors:
-        from_name = get_city_name_uz(monitor['station_from'])
-        to_name = get_city_name_uz(monitor['station_to'])
 
-        response += (
-            f"🚆 {from_name} → {to_name}\n"
-            f"   Date: {monitor['travel_date']}\n"
-            f"   Interval: Every {monitor['check_interval']} min\n"
-            f"   ID: {monitor['id']}\n\n"
-        )
+async def stop_all_monitors_handler(callback: CallbackQuery, payload: str, state: FSMContext):
+    """Stop all monitors for the user."""
+    await stop_all_user_monitors(callback.from_user.id)
+    _answer_in_background(callback, "All monitors stopped")
+    await _edit_text_if_changed(callback.message, "✅ All monitors stopped.")
+
+
+# === CALLBACK ROUTING ===
+
+# Callback data is "<tag>" or "<tag>:<payload>". Handlers are looked up by
+# (tag, FSM state); a state of None means the handler works in any state.
+CallbackHandler = Callable[[CallbackQuery, str, FSMContext], Awaitable[None]]
+
+_CALLBACK_HANDLERS: dict[tuple[str, str | None], CallbackHandler] = {
+    ("c", TrainSearch.choosing_from.state): process_from_city,
+    ("c", TrainSearch.choosing_to.state): process_to_city,
+    ("d", TrainSearch.choosing_date.state): process_date,
+    ("r", None): restart_search,
+    ("su", None): setup_monitor_handler,
+    ("i", MonitorSetup.choosing_interval.state): process_interval_selection,
+    ("sm", None): stop_monitor_handler,
+    ("sa", None): stop_all_monitors_handler,
+}
+
+
+# Buttons sent by older bot versions are still in users' chats
+_LEGACY_CALLBACK_TAGS = {
+    "restart": "r",
+    "setup_monitor": "su",
+    "stop_all_monitors": "sa",
+}
+_LEGACY_CALLBACK_PREFIXES = (
+    ("city_", "c"),
+    ("date_", "d"),
+    ("interval_", "i"),
+    ("stop_monitor_", "sm"),
+)
 
-        buttons.append([
-            InlineKeyboardButton(
-                text=f"Stop {from_name} → {to_name}",
-                callback_data=f"stop_monitor_{monitor['id']}"
-            )
-        ])
 
-    buttons.append([
-        InlineKeyboardButton(text="Stop All Monitors", callback_data="stop_all_monitors")
-    ])
+def _parse_legacy_callback(data: str) -> tuple[str, str]:
+    """Translate old-style callback data to (tag, payload)."""
+    tag = _LEGACY_CALLBACK_TAGS.get(data)
+    if tag is not None:
+        return tag, ""
+    for prefix, tag in _LEGACY_CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return tag, data[len(prefix):]
+    return data, ""
+
+
+@dp.callback_query()
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext):
+    """Route a callback query to its handler with a single dict lookup."""
+    data = callback.data or ""
+    tag, sep, payload = data.partition(":")
+    if not sep and (tag, None) not in _CALLBACK_HANDLERS:
+        tag, payload = _parse_legacy_callback(data)
+
+    handler = _CALLBACK_HANDLERS.get((tag, None))
+    if handler is None:
+        handler = _CALLBACK_HANDLERS.get((tag, await state.get_state()))
+
+    if handler is None:
+        # Stale button from an earlier step
+        await callback.answer(
+            "This button is outdated. Use /start or /monitors.", show_alert=True
+        )
+        return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await callback.message.edit_text(response, reply_markup=keyboard)
+    await handler(callback, payload, state)
 
 
-@dp.callback_query(F.data == "stop_all_monitors")
-async def stop_all_monitors_handler(callback: CallbackQuery):
-    """Stop all monitors for the user."""
-    await stop_all_user_monitors(callback.from_user.id)
-    await callback.message.edit_text("✅ All monitors stopped.")
-    await callback.answer("All monitors stopped", show_alert=True)
+async def run_webhook():
+    """Serve updates from Telegram's webhook until cancelled."""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET
+    ).register(app, path=urlsplit(WEBHOOK_URL).path or "/")
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        # Polling subscribes only to handled update types by default;
+        # set_webhook has to be told explicitly
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info("Listening for webhook updates on %s:%s", WEBHOOK_HOST, WEBHOOK_PORT)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
@@ -445,11 +644,21 @@ async def main():
     monitor_task = asyncio.create_task(monitor_loop(bot))
 
     try:
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # getUpdates is refused while a webhook is set
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
         monitor_task.cancel()
+        await close_database()
 
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())